@@ -1,15 +1,35 @@
 # Import libraries
-from kasa.iot import iotdevice
+from __future__ import annotations  # postponed annotations
+from typing import TYPE_CHECKING  # type checking imports
 import asyncio  # async io
-import platform  # platform
 import argparse  # argument parsing
-import re  # regex
+import ipaddress  # IP address parsing
+import json  # JSON encoding
 import logging  # Logging
+import logging.handlers  # Logging handlers
+import os  # OS functions
+import queue  # queues
+import sys  # system functions
+import time  # time functions
 from pathlib import Path  # Path functions
 
-# Set platform policy
-if platform.system() == 'Windows':
-    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+# The kasa library is imported where a device is connected, so --help and commands
+#  sent through pyKasad don't pay for importing it
+if TYPE_CHECKING:
+    from kasa import DeviceType
+    from kasa.iot import iotdevice
+
+# Set platform policy (asyncio only provides the selector policy on Windows)
+windows_selector_policy = getattr(asyncio, 'WindowsSelectorEventLoopPolicy', None)
+if windows_selector_policy is not None:
+    asyncio.set_event_loop_policy(windows_selector_policy())
+else:
+    # Use the faster uvloop event loop, if it is installed
+    try:
+        import uvloop  # uvloop event loop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
 # Set a default command response timeout (in seconds)
 command_timeout_default = 3
@@ -17,29 +37,44 @@ command_timeout_default = 3
 # List of valid device command options
 command_options = ['on', 'off', 'hw-info', 'status']
 
-# CMD Line Parser
-parser = argparse.ArgumentParser(description='Control a TP-Link Kasa Smart Device.')
-parser.add_argument('--ip', help='The IP address of the device', required=True)
-parser.add_argument('--children',
-                    help='Zero-based, comma-separated list of child devices to target (for devices like power strips). '
-                         'Example: 0,1,2',
-                    default='all')
-parser.add_argument('--command', help='Command to run', choices=command_options, required=True)
-parser.add_argument('--timeout', type=int,
-                    help='Timeout for command (in seconds)', default=command_timeout_default)
-parser.add_argument('--log', help='File path for log file. Defaults to script folder if omitted')
-parser.add_argument('--debug', type=bool, help='Verbose mode for debugging', nargs='?', const=True)
-
-# Get CMD Args
-args = parser.parse_args()
-logLevel = logging.DEBUG if args.debug else logging.INFO
+# Device types that have child devices
+strip_device_types = frozenset({'Strip', 'StripSocket'})
+
+# Set a default number of log records to buffer before writing them to the log file
+log_file_buffer_size_default = 100
+
+# Unix socket of the pyKasad daemon, which keeps device connections open between commands
+#  (in the user's runtime directory, if there is one, rather than the shared /tmp)
+daemon_socket_path = str(Path(os.environ.get('XDG_RUNTIME_DIR', '/tmp')) / 'pykasa.sock')
 
 # Initialize logger (so functions can utilize it)
 loggerName = "myLogger"
-logPath = args.log if args.log else "."
 logger = logging.getLogger(loggerName)
 
 
+# Class for log formatting that reuses the formatted date and time for records
+#  logged within the same second
+class CachedTimeFormatter(logging.Formatter):
+    def __init__(self, fmt: str = None):
+        super().__init__(fmt)
+        self._cached_second = None
+        self._cached_time = None
+
+    def formatTime(self, record, datefmt=None):
+        # Only format the date and time when the second changes
+        second = int(record.created)
+        if second != self._cached_second:
+            self._cached_second = second
+            self._cached_time = time.strftime(self.default_time_format, self.converter(record.created))
+
+        return self.default_msec_format % (self._cached_time, record.msecs)
+
+
+# Log formatters for console and log file output
+console_formatter = CachedTimeFormatter('%(asctime)s | %(levelname)s: %(message)s')
+file_formatter = CachedTimeFormatter('%(asctime)s | %(levelname)s | %(lineno)d: %(message)s')
+
+
 # Class for exceptions from the TpLinkKasaDevice class
 class TpLinkKasaDeviceException(Exception):
     pass
@@ -60,6 +95,28 @@ class TpLinkKasaDeviceHardwareInfo:
             self.type, self.sw_version, self.hw_version, self.mac_address)
 
 
+# Class for the on/off state of a TP-Link Kasa Smart Device (and its children), read
+#  from a single system info query
+class TpLinkKasaDeviceState:
+    def __init__(self, alias: str, device_type: DeviceType, is_on: bool, children: list = None):
+        self.alias = alias
+        self.device_type = device_type
+        self.is_on = is_on
+        self.children = children if children is not None else []
+
+    def __repr__(self):
+        return '<{} {} - {} ({})>'.format(
+            type(self).__name__, self.device_type, self.alias, "ON" if self.is_on else "OFF")
+
+    @property
+    def is_off(self):
+        return not self.is_on
+
+    async def disconnect(self):
+        # The state was read over a connection that has already been closed
+        pass
+
+
 # Class to wrap a TP-Link Kasa Smart Device
 class TpLinkKasaDevice:
     def __init__(self, ip: str, iot_device: iotdevice.Device = None, logger: logging.Logger = None):
@@ -67,21 +124,24 @@ class TpLinkKasaDevice:
         self.iot_device = iot_device
         self._logger = logger
 
+        # Check once whether the device has children (a "Strip" or "StripSocket")
+        self._is_strip = iot_device is not None and iot_device.device_type.name in strip_device_types
+
     def __str__(self):
         return 'IP: {} | Name: {} | Device Type: {}'.format(
             self.ip, self.iot_device.alias, self.iot_device.device_type)
 
     @staticmethod
     async def connect(ip: str, logger: logging.Logger = None):
+        from kasa.iot import iotdevice
+
         # Connect to the Kasa device
         iot_device = await iotdevice.Device.connect(host=ip)
 
         # If the device connection was successful, create an object to wrap it
         #  and return the wrapper object
         if iot_device:
-            kasa_device = TpLinkKasaDevice(ip)
-            kasa_device.iot_device = iot_device
-            kasa_device._logger = logger
+            kasa_device = TpLinkKasaDevice(ip, iot_device, logger)
 
             logger.info(kasa_device)
             return kasa_device
@@ -89,91 +149,167 @@ class TpLinkKasaDevice:
             # Raise an error if the connection failed
             raise TpLinkKasaDeviceException("Could not connect to Kasa device at '{}".format(ip))
 
+    @staticmethod
+    async def connect_for_status(ip: str, logger: logging.Logger = None):
+        from kasa import DeviceType
+        from kasa.iot import iotdevice
+
+        # Query just the system info of the Kasa device, instead of the state of every module
+        iot_device = iotdevice.IotDevice(ip)
+        try:
+            sys_info = await iot_device._query_helper('system', 'get_sysinfo')
+        finally:
+            await iot_device.disconnect()
+
+        # Only relay devices (plugs, strips, wall switches and dimmers) report their on/off state
+        #  in the system info, so fully connect to any other type of device
+        if 'relay_state' not in sys_info and 'children' not in sys_info:
+            return await TpLinkKasaDevice.connect(ip, logger)
+
+        # Find the device type the way kasa does (from the wrapped query response), and fully
+        #  connect to the device if the type can't be found this way
+        try:
+            device_type = iotdevice.IotDevice._get_device_type_from_sys_info({'system': {'get_sysinfo': sys_info}})
+        except Exception as e:
+            logger.debug("Could not find the device type from the system info: %s", e)
+            return await TpLinkKasaDevice.connect(ip, logger)
+
+        # Wrap the state of the device and its children
+        children = [TpLinkKasaDeviceState(child.get('alias'), DeviceType.StripSocket, bool(child.get('state')))
+                    for child in sys_info.get('children', [])]
+        is_on = bool(sys_info.get('relay_state')) or any(child.is_on for child in children)
+        device_state = TpLinkKasaDeviceState(sys_info.get('alias'), device_type, is_on, children)
+
+        kasa_device = TpLinkKasaDevice(ip, device_state, logger)
+
+        logger.info(kasa_device)
+        return kasa_device
+
+    async def disconnect(self):
+        # Close the connection to the Kasa device
+        await self.iot_device.disconnect()
+
     async def do_action(self, command: str = 'status', children=None):
         # Create an empty list for child devices, if no list was provided
         if children is None:
             children = []
         else:
-            # Sort the child list
-            children.sort()
+            # Sort the child list, dropping repeated indexes so no child is sent a command twice
+            children = sorted(set(children))
 
         # Get the current device
         current_device = self.iot_device
-        self._logger.debug("Current Device: {}".format(current_device))
-
-        # Start a list of devices to perform the action upon
-        devices_to_action = []
+        self._logger.debug("Current Device: %s", current_device)
 
         # Check if the current device has children (a "Strip" or "StripSocket")
-        if current_device.device_type in (current_device.device_type.Strip, current_device.device_type.StripSocket):
+        if self._is_strip:
+            # Look up the child devices just once
+            child_devices = current_device.children
+            child_count = len(child_devices)
+
             # Check if a list of child devices was provided
             if len(children) > 0:
-                # Include child devices as specific indexes
-                for child in children:
-                    try:
-                        # Access the child device at the given index
-                        devices_to_action.append(current_device.children[child])
-                    except Exception as e:
-                        self._logger.error("Error accessing child device at index {} - {}".format(child, e))
+                # Include child devices at the given indexes
+                devices_to_action = [child_devices[child] for child in children if 0 <= child < child_count]
+
+                # Report any indexes without a child device
+                if len(devices_to_action) < len(children):
+                    self._logger.error("Error accessing child devices at indexes %s - the device has %s children",
+                                       [child for child in children if not 0 <= child < child_count], child_count)
             else:
                 # Include all children
-                devices_to_action = current_device.children
+                devices_to_action = list(child_devices)
         else:
             # If the device doesn't have children, target just the current device
-            devices_to_action.append(current_device)
+            devices_to_action = [current_device]
 
         # Determine the command to run
-        self._logger.info("Command to run: {}".format(command))
+        self._logger.info("Command to run: %s", command)
 
-        # Loop through the list of devices to action
-        for device in devices_to_action:
-            self._logger.debug("Running '{}' command on Device: {}".format(command, device.alias))
+        # Look up the action for the command
+        action = command_actions.get(command)
+        if action is None:
+            self._logger.critical('Unknown or unsupported command: %s', command)
+            return
 
-            # Create a string to track device state change
-            state_change_string = ""
+        await action(self, current_device, devices_to_action)
 
-            if command == "on":
-                try:
-                    if device.is_off:
-                        state_change_string = "=> changing state to ON"
-                        await device.turn_on()
-                        await device.update()
-                    else:
-                        state_change_string = "=> is already ON"
-                except Exception as e:
-                    self._logger.error("Error performing action on device '{}': {}".format(device.alias, e))
-            elif command == "off":
-                try:
-                    if device.is_on:
-                        state_change_string = "=> changing state to OFF"
-                        await device.turn_off()
-                    else:
-                        state_change_string = "=> is already OFF"
-                except Exception as e:
-                    self._logger.error("Error performing action on device '{}': {}".format(device.alias, e))
-            elif command == "hw-info":
-                try:
-                    # Show device and hardware info status just once, and then break out of the loop
-                    device_hw_info = TpLinkKasaDeviceHardwareInfo(device.hw_info)
+    async def turn_on(self, current_device: iotdevice.Device, devices: list):
+        await self.change_devices_state(current_device, devices, True)
+
+    async def turn_off(self, current_device: iotdevice.Device, devices: list):
+        await self.change_devices_state(current_device, devices, False)
+
+    async def show_hw_info(self, current_device: iotdevice.Device, devices: list):
+        for device in devices:
+            self._logger.debug("Running 'hw-info' command on Device: %s", device.alias)
+
+            try:
+                # Show device and hardware info status just once
+                device_hw_info = str(TpLinkKasaDeviceHardwareInfo(device.hw_info))
 
-                    self._logger.debug("Device Hardware Info: {}".format(device_hw_info))
+                self._logger.debug("Device Hardware Info: %s", device_hw_info)
 
-                    state_change_string = "\nHardware Info:\n{}".format(device_hw_info)
+                state_change_string = "\nHardware Info:\n" + device_hw_info
 
-                    await self.show_device_state(current_device, None, state_change_string)
-                    break
+                self.show_device_state(current_device, None, state_change_string)
+                return
+            except Exception as e:
+                self._logger.error("Error performing action on device '%s': %s", device.alias, e)
+
+            # Show status for current device
+            self.show_device_state(current_device, device)
+
+    async def show_status(self, current_device: iotdevice.Device, devices: list):
+        for device in devices:
+            self._logger.debug("Running 'status' command on Device: %s", device.alias)
+
+            # Show status for current device
+            self.show_device_state(current_device, device)
+
+    async def change_devices_state(self, current_device: iotdevice.Device, devices: list, turn_on: bool):
+        state_string = "ON" if turn_on else "OFF"
+
+        # Note which devices need a state change before any command is sent
+        changing = [device.is_off if turn_on else device.is_on for device in devices]
+
+        if self._logger.isEnabledFor(logging.DEBUG):
+            for device in devices:
+                self._logger.debug("Running '%s' command on Device: %s", state_string.lower(), device.alias)
+
+        # Send the state change to every device that needs it, collecting each device's error so one
+        #  failing device doesn't stop the rest (strip children share the parent's connection, so
+        #  kasa still sends the requests one at a time)
+        devices_to_change = [device for device, change in zip(devices, changing) if change]
+        results = iter(())
+        if devices_to_change:
+            results = iter(await asyncio.gather(
+                *(device.turn_on() if turn_on else device.turn_off() for device in devices_to_change),
+                return_exceptions=True))
+
+            # Refresh the state of turned on devices with a single update of the parent device
+            if turn_on:
+                try:
+                    await current_device.update()
                 except Exception as e:
-                    self._logger.error("Error performing action on device '{}': {}".format(device.alias, e))
-            elif command == "status":
-                state_change_string = ""
+                    self._logger.error("Error updating device '%s': %s", current_device.alias, e)
+
+        # Show the outcome for each device
+        changed_string = "=> changing state to {}".format(state_string)
+        unchanged_string = "=> is already {}".format(state_string)
+        for device, change in zip(devices, changing):
+            if change:
+                state_change_string = changed_string
+                result = next(results)
+                if isinstance(result, Exception):
+                    self._logger.error("Error performing action on device '%s': %s", device.alias, result)
             else:
-                logger.critical('Unknown or unsupported command: {}'.format(command))
+                state_change_string = unchanged_string
 
-            # Show status for current device
-            await self.show_device_state(current_device, device, state_change_string)
+            self.show_device_state(current_device, device, state_change_string)
 
-    async def show_device_state(self, current_device: iotdevice.Device, child: iotdevice.Device = None,
-                                state_change_string: str = ""):
+    def show_device_state(self, current_device: iotdevice.Device, child: iotdevice.Device = None,
+                          state_change_string: str = ""):
         if child is None:
             child_string = ""
             child_state_string = ""
@@ -181,58 +317,160 @@ class TpLinkKasaDevice:
             child_string = "| Child: {} |".format(child.alias)
             child_state_string = "State: {} ".format("ON" if child.is_on else "OFF")
 
-        self._logger.info("Device: {} {} {} {}".format(
-            current_device.alias, child_string, child_state_string, state_change_string))
+        self._logger.info("Device: %s %s %s %s",
+                          current_device.alias, child_string, child_state_string, state_change_string)
+
+
+# Device actions for each command option
+command_actions = {
+    'on': TpLinkKasaDevice.turn_on,
+    'off': TpLinkKasaDevice.turn_off,
+    'hw-info': TpLinkKasaDevice.show_hw_info,
+    'status': TpLinkKasaDevice.show_status,
+}
 
 
 # Methods
-async def run_command(device_ip, command, children=None):
+async def run_command(device_connection, command, children=None):
     if children is None:
         children = []
 
-    # Access the smart device
-    device = await TpLinkKasaDevice.connect(device_ip, logger)
+    # Wait for the connection to the smart device
+    device = await device_connection
+
+    logger.debug("Running command: %s", command)
+
+    # Perform command, sending every request over the same connection, and then close it
+    try:
+        await device.do_action(command=command, children=children)
+    finally:
+        # Don't let closing the connection hang, or replace the error (or timeout) from the command
+        try:
+            async with asyncio.timeout(command_timeout_default):
+                await device.disconnect()
+        except Exception as e:
+            logger.debug("Error disconnecting from device at %s: %s", device.ip, e)
 
-    logger.debug("Running command: {}".format(command))
 
-    # Perform command
-    await device.do_action(command=command, children=children)
+async def open_daemon_connection(socket_path: str = daemon_socket_path):
+    # Unix sockets aren't available on every platform
+    if not hasattr(asyncio, 'open_unix_connection'):
+        return None
 
+    # Connect to the pyKasad daemon, if it is running. Only trust a socket owned by the current
+    #  user, as another user could otherwise answer commands in its place.
+    try:
+        if os.stat(socket_path).st_uid != os.getuid():
+            logger.debug("Ignoring pyKasad socket %s, as it is owned by another user", socket_path)
+            return None
 
-def config_logger(log_name_prefix, log_level, log_path):
-    # Log path existence / creation
-    Path(log_path).mkdir(parents=True, exist_ok=True)
+        return await asyncio.open_unix_connection(socket_path)
+    except OSError:
+        return None
+
+
+async def run_daemon_command(daemon_connection, device_ip, command, children, timeout):
+    reader, writer = daemon_connection
+
+    # Send the command to the daemon and wait for its response
+    try:
+        request = {'ip': device_ip, 'command': command, 'children': children, 'timeout': timeout,
+                   'log_level': logger.getEffectiveLevel()}
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        response_line = await reader.readline()
+    finally:
+        writer.close()
+
+    # The daemon closes the connection without a response if it fails unexpectedly
+    if not response_line:
+        raise TpLinkKasaDeviceException("pyKasad closed the connection without responding")
+
+    response = json.loads(response_line)
+
+    # Log the messages from running the command, as if it had run here
+    for level, message in response['log']:
+        logger.log(level, message)
+
+    # Raise an error if the daemon couldn't run the command
+    if response.get('error'):
+        raise TpLinkKasaDeviceException(response['error'])
 
-    # Log filename
-    log_file_name = '{}/{}.log'.format(log_path, log_name_prefix)
 
+def config_logger(log_name_prefix, log_level, log_path, log_file_buffer_size=log_file_buffer_size_default):
     # Get logger
     my_logger = logging.getLogger(loggerName)
 
+    # Only configure the logger once, so repeated calls don't duplicate every log write
+    #  (other handlers may have been added to the logger by a program importing this module)
+    queue_listener = next((handler.listener for handler in my_logger.handlers
+                           if isinstance(handler, logging.handlers.QueueHandler)), None)
+    if queue_listener is not None:
+        return queue_listener
+
+    # Log path existence / creation
+    log_dir = Path(log_path)
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    # Log filename
+    log_file = log_dir / '{}.log'.format(log_name_prefix)
+
     # Set lowest allowed logger severity
-    logger.setLevel(logging.DEBUG)
+    my_logger.setLevel(log_level)
 
     # Console output handler
     console_handler = logging.StreamHandler()
     console_handler.setLevel(log_level)
-    console_handler.setFormatter(logging.Formatter('%(asctime)s | %(levelname)s: %(message)s'))
-    logger.addHandler(console_handler)
+    console_handler.setFormatter(console_formatter)
 
-    # Log file output handler
-    file_handler = logging.FileHandler(log_file_name)
+    # Log file output handler (the file is only opened once a record is written to it)
+    file_handler = logging.FileHandler(log_file, encoding='utf-8', delay=True)
     file_handler.setLevel(log_level)
-    file_handler.encoding = 'utf-8'
-    file_handler.setFormatter(logging.Formatter('%(asctime)s | %(levelname)s | %(lineno)d: %(message)s'))
-    logger.addHandler(file_handler)
+    file_handler.setFormatter(file_formatter)
+
+    # Buffer the log file records, so they are written in batches. The buffer is written out
+    #  when it fills up, when an error is logged and when logging shuts down at exit.
+    if log_file_buffer_size > 0:
+        file_handler = logging.handlers.MemoryHandler(
+            log_file_buffer_size, flushLevel=logging.ERROR, target=file_handler)
+        file_handler.setLevel(log_level)
 
-    # Return configured logger
-    return my_logger
+    # Queue the log records, so the console and file writes happen on a listener thread
+    #  instead of blocking the event loop
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.listener = logging.handlers.QueueListener(
+        log_queue, console_handler, file_handler, respect_handler_level=True)
+    my_logger.addHandler(queue_handler)
+
+    # Return the listener that writes queued records to the output handlers
+    return queue_handler.listener
+
+
+# CMD Line Parser
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Control a TP-Link Kasa Smart Device.')
+    parser.add_argument('--ip', help='The IP address of the device', required=True)
+    parser.add_argument('--children',
+                        help='Zero-based, comma-separated list of child devices to target '
+                             '(for devices like power strips). Example: 0,1,2',
+                        default='all')
+    parser.add_argument('--command', help='Command to run', choices=command_options, required=True)
+    parser.add_argument('--timeout', type=int,
+                        help='Timeout for command (in seconds)', default=command_timeout_default)
+    parser.add_argument('--log', help='File path for log file. Defaults to script folder if omitted')
+    parser.add_argument('--debug', type=bool, help='Verbose mode for debugging', nargs='?', const=True)
+
+    # Get CMD Args
+    return parser.parse_args(argv)
 
 
 # Main function
-async def main():
-    # Configure logging
-    logger = config_logger(Path(parser.prog).stem, logLevel, logPath)
+async def main(argv=None):
+    # Get CMD Args
+    args = parse_args(argv)
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    log_path = args.log if args.log else "."
 
     # Check for valid command
     command = args.command
@@ -240,48 +478,68 @@ async def main():
     # Get command timeout
     command_timeout = args.timeout
 
-    #  if command in valid_commands:
-    if command in command_options:
-        # Check for valid IP Address from CMD Args
-        if re.match(
-                r"(?:\b(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\b)\Z",
-                args.ip):
-            # Successful match at the start of the string
-            device_ip = args.ip
-        else:
-            # IP match attempt failed
-            logger.critical('Invalid IP Address: {}'.format(args.ip))
-            exit()
-
-        if re.match(r"^all|([0-9](,[0-9])*)$", args.children):
-            if re.match(r"^all$", args.children):
-                children = []
+    # Check for valid IP Address from CMD Args
+    try:
+        device_ip = str(ipaddress.IPv4Address(args.ip))
+    except ValueError:
+        device_ip = None
+
+    # Start connecting to the device straight away, so the connection is set up while
+    #  logging is configured (the command timeout is counted from here). Use the
+    #  pyKasad daemon's open connection to the device instead, if the daemon is running.
+    daemon_connection = None
+    device_connection = None
+    if command in command_options and device_ip:
+        command_deadline = asyncio.get_running_loop().time() + command_timeout
+        daemon_connection = await open_daemon_connection()
+        if daemon_connection is None:
+            # Only the device state is needed to show its status
+            connect = TpLinkKasaDevice.connect_for_status if command == 'status' else TpLinkKasaDevice.connect
+            device_connection = asyncio.create_task(connect(device_ip, logger))
+            await asyncio.sleep(0)
+
+    # Configure logging and start writing log records
+    log_listener = config_logger(Path(sys.argv[0]).stem, log_level, log_path)
+    log_listener.start()
+
+    try:
+        #  if command in valid_commands:
+        if command in command_options:
+            if device_ip is None:
+                # IP address parsing failed
+                logger.critical('Invalid IP Address: %s', args.ip)
+                return 1
+
+            # Get the child devices to target (all of them, unless a valid list of indexes was given)
+            child_indexes = args.children.split(',')
+            if args.children != 'all' and all(child.isdecimal() for child in child_indexes):
+                children = list(map(int, child_indexes))
             else:
-                children = ",".join(args.children)
-                children = list(map(int, args.children.split(",")))
-        else:
-            children = []
+                children = []
 
-        # Try to run command
-        try:
-            # Set a timeout
-            async with asyncio.timeout(command_timeout):
-                # Attempt to run the command
-                await run_command(device_ip, command, children)
-        except asyncio.TimeoutError as te:
-            logger.critical('Error: Command "{}" timed out for device at {} | {}'.format(
-                command,
-                device_ip,
-                te))
-        except Exception as e:
-            logger.critical('Error: {}'.format(e))
-    else:
-        logger.critical('Invalid command: {}'.format(command))
-        exit()
+            # Try to run command
+            try:
+                # Set a timeout
+                async with asyncio.timeout_at(command_deadline):
+                    # Attempt to run the command
+                    if daemon_connection:
+                        await run_daemon_command(daemon_connection, device_ip, command, children, command_timeout)
+                    else:
+                        await run_command(device_connection, command, children)
+            except asyncio.TimeoutError as te:
+                logger.critical('Error: Command "%s" timed out for device at %s | %s', command, device_ip, te)
+                return 1
+            except Exception as e:
+                logger.critical('Error: %s', e)
+                return 1
+        else:
+            logger.critical('Invalid command: %s', command)
+            return 1
+    finally:
+        # Write out any queued log records
+        log_listener.stop()
 
 
 # Initiate main
 if __name__ == "__main__":
-    asyncio.run(main())
-else:
-    help()
+    sys.exit(asyncio.run(main()) or 0)
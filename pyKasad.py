@@ -0,0 +1,230 @@
+# Import libraries
+import asyncio  # async io
+import argparse  # argument parsing
+import json  # JSON encoding
+import logging  # Logging
+import signal  # signal handling
+import sys  # system functions
+from pathlib import Path  # Path functions
+import pyKasa  # TP-Link Kasa device wrapper
+
+# Set a default time (in seconds) that an unused device connection is kept open
+idle_timeout_default = 60
+
+# Initialize logger (so functions can utilize it)
+logger = pyKasa.logger
+
+
+# Class to collect the log records of a single daemon request
+class RequestLogHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append([record.levelno, record.getMessage()])
+
+
+# Class for a device connection kept open by the daemon
+class CachedKasaDevice:
+    def __init__(self, kasa_device: pyKasa.TpLinkKasaDevice, last_used: float):
+        self.kasa_device = kasa_device
+        self.last_used = last_used
+
+
+# Class for the lock that runs one command at a time on a device, and the number of
+#  requests using it
+class DeviceLock:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+# Class to serve pyKasa commands over a Unix socket, reusing device connections
+class PyKasaDaemon:
+    def __init__(self, idle_timeout: int = idle_timeout_default):
+        self.idle_timeout = idle_timeout
+        self._devices = {}
+        self._locks = {}
+
+    async def serve(self, socket_path: str = pyKasa.daemon_socket_path):
+        # Don't take over the socket of a daemon that is already running
+        daemon_connection = await pyKasa.open_daemon_connection(socket_path)
+        if daemon_connection:
+            daemon_connection[1].close()
+            raise pyKasa.TpLinkKasaDeviceException("pyKasad is already running at '{}'".format(socket_path))
+
+        # Remove a socket left behind by a previous daemon
+        Path(socket_path).unlink(missing_ok=True)
+
+        server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+        logger.info("Listening on %s", socket_path)
+
+        # Only let the current user send commands to the daemon
+        Path(socket_path).chmod(0o600)
+
+        # Shut down cleanly when the daemon is stopped with SIGTERM, as with Ctrl+C
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        async with server:
+            # Close idle device connections while serving requests
+            evict_task = asyncio.create_task(self.evict_idle_devices())
+            try:
+                await server.serve_forever()
+            finally:
+                evict_task.cancel()
+                await self.close_devices()
+
+                # Remove the socket, as closing the server leaves it behind
+                Path(socket_path).unlink(missing_ok=True)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Ignore clients that disconnect without sending a request (such as the running check in serve)
+            request_line = await reader.readline()
+            if not request_line:
+                return
+
+            request = json.loads(request_line)
+            response = await self.run_request(request)
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        except Exception as e:
+            logger.error("Error handling request: %s", e)
+
+            # Let the client know the request failed, instead of closing the connection without a response
+            try:
+                writer.write(json.dumps({'log': [], 'error': str(e)}).encode() + b'\n')
+                await writer.drain()
+            except Exception:
+                pass
+        finally:
+            writer.close()
+
+    async def run_request(self, request: dict):
+        device_ip = request['ip']
+
+        # Collect the log records for this request, so they can be sent back to the client
+        log_handler = RequestLogHandler()
+        request_logger = logging.Logger(pyKasa.loggerName, request.get('log_level', logging.INFO))
+        request_logger.addHandler(log_handler)
+
+        response = {'log': log_handler.records}
+
+        # Don't connect to the device for a command that can't be run
+        if request['command'] not in pyKasa.command_options:
+            response['error'] = 'Invalid command: {}'.format(request['command'])
+            return response
+
+        # Only run one command at a time on each device
+        device_lock = self._locks.setdefault(device_ip, DeviceLock())
+        device_lock.users += 1
+        try:
+            async with device_lock.lock:
+                async with asyncio.timeout(request.get('timeout', pyKasa.command_timeout_default)):
+                    kasa_device = await self.get_device(device_ip, request_logger)
+                    await kasa_device.do_action(command=request['command'], children=request.get('children'))
+        except asyncio.TimeoutError:
+            # Drop the connection, as the device may no longer be reachable at this address
+            await self.close_device(device_ip)
+            response['error'] = 'Command "{}" timed out for device at {}'.format(request['command'], device_ip)
+        except Exception as e:
+            await self.close_device(device_ip)
+            response['error'] = str(e)
+        finally:
+            # Forget the lock once no request is using it, so a lock isn't kept for every IP ever requested
+            device_lock.users -= 1
+            if device_lock.users == 0:
+                del self._locks[device_ip]
+
+        return response
+
+    async def get_device(self, device_ip: str, request_logger: logging.Logger):
+        loop = asyncio.get_running_loop()
+        cached_device = self._devices.get(device_ip)
+
+        if cached_device is None:
+            # Connect to the device and keep the connection for later requests
+            kasa_device = await pyKasa.TpLinkKasaDevice.connect(device_ip, request_logger)
+            self._devices[device_ip] = CachedKasaDevice(kasa_device, loop.time())
+            logger.debug("Connected to device at %s", device_ip)
+        else:
+            # Refresh the state of the device over its open connection
+            kasa_device = cached_device.kasa_device
+            kasa_device._logger = request_logger
+            await kasa_device.iot_device.update()
+            cached_device.last_used = loop.time()
+
+            request_logger.info(kasa_device)
+
+        return kasa_device
+
+    async def evict_idle_devices(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.idle_timeout)
+
+            # Close connections that haven't been used within the idle timeout (and have no requests running)
+            for device_ip, cached_device in list(self._devices.items()):
+                if loop.time() - cached_device.last_used >= self.idle_timeout and device_ip not in self._locks:
+                    await self.close_device(device_ip)
+
+    async def close_device(self, device_ip: str):
+        cached_device = self._devices.pop(device_ip, None)
+        if cached_device is None:
+            return
+
+        try:
+            await cached_device.kasa_device.disconnect()
+        except Exception as e:
+            logger.error("Error disconnecting from device at %s: %s", device_ip, e)
+
+        logger.debug("Closed connection to device at %s", device_ip)
+
+    async def close_devices(self):
+        for device_ip in list(self._devices):
+            await self.close_device(device_ip)
+
+
+# CMD Line Parser
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Keep TP-Link Kasa Smart Device connections open for pyKasa commands.')
+    parser.add_argument('--idle-timeout', type=int,
+                        help='Time (in seconds) to keep an unused device connection open',
+                        default=idle_timeout_default)
+    parser.add_argument('--log', help='File path for log file. Defaults to script folder if omitted')
+    parser.add_argument('--debug', type=bool, help='Verbose mode for debugging', nargs='?', const=True)
+
+    # Get CMD Args
+    return parser.parse_args(argv)
+
+
+# Main function
+async def main(argv=None):
+    # Get CMD Args
+    args = parse_args(argv)
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    log_path = args.log if args.log else "."
+
+    # Configure logging and start writing log records
+    #  (without buffering the log file, so it stays up to date while the daemon runs)
+    log_listener = pyKasa.config_logger(Path(sys.argv[0]).stem, log_level, log_path, log_file_buffer_size=0)
+    log_listener.start()
+
+    try:
+        await PyKasaDaemon(args.idle_timeout).serve()
+    except asyncio.CancelledError:
+        # The daemon was stopped
+        logger.info("Stopped")
+    except Exception as e:
+        logger.critical('Error: %s', e)
+        return 1
+    finally:
+        # Write out any queued log records
+        log_listener.stop()
+
+
+# Initiate main
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()) or 0)